@@ -4,12 +4,24 @@ import logging
 from typing import Optional
 import asyncio
 import re
+import time
+import math
+import heapq
+import hashlib
+import itertools
+import contextvars
+import secrets
+import sys
+import threading
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
 
 import httpx
-import yaml
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from starlette.middleware.base import BaseHTTPMiddleware
 
 # Configure logging
@@ -23,10 +35,58 @@ logger = logging.getLogger(__name__)
 HA_BASE_URL = os.environ.get("HA_BASE_URL", "http://homeassistant:8123")
 HTTP_TIMEOUT = 30.0
 
+# Admission control (per-token limits, global upstream cap, priority queueing)
+ADMISSION_PER_TOKEN_CONCURRENCY = int(os.environ.get("ADMISSION_PER_TOKEN_CONCURRENCY", "4"))
+ADMISSION_PER_TOKEN_RATE = float(os.environ.get("ADMISSION_PER_TOKEN_RATE", "5"))  # tool calls per second
+ADMISSION_PER_TOKEN_BURST = int(os.environ.get("ADMISSION_PER_TOKEN_BURST", "20"))
+ADMISSION_UPSTREAM_CONCURRENCY = int(os.environ.get("ADMISSION_UPSTREAM_CONCURRENCY", "8"))
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "32"))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "10"))
+
+# Connection pooling, response cache and warm-up
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "60"))
+CACHE_TTL_CONFIG = float(os.environ.get("CACHE_TTL_CONFIG", "300"))
+CACHE_TTL_SERVICES = float(os.environ.get("CACHE_TTL_SERVICES", "300"))
+CACHE_TTL_STATES = float(os.environ.get("CACHE_TTL_STATES", "2"))
+WARMUP_TOKEN = os.environ.get("HA_WARMUP_TOKEN")
+WARMUP_CONNECTIONS = int(os.environ.get("WARMUP_CONNECTIONS", "2"))
+READINESS_PROBE_INTERVAL = 10.0
+
+# Change feed (state_changed subscription over the Home Assistant websocket API)
+CHANGE_FEED_SIZE = int(os.environ.get("CHANGE_FEED_SIZE", "2000"))
+CHANGE_FEED_START_TIMEOUT = 10.0
+# How long a non-admin caller's visible entity list is reused to filter the feed
+CHANGE_FEED_VISIBILITY_TTL = 60.0
+ADMIN_CHECK_TTL = 300.0
+WAIT_DEFAULT_TIMEOUT = 60.0
+WAIT_MAX_TIMEOUT = float(os.environ.get("WAIT_MAX_TIMEOUT", "300"))
+WAIT_MAX_WAITERS = int(os.environ.get("WAIT_MAX_WAITERS", "256"))
+WAIT_MAX_PER_TOKEN = int(os.environ.get("WAIT_MAX_PER_TOKEN", "16"))
+
+# media_player.browse_media result cache and pagination
+BROWSE_MEDIA_CACHE_TTL = float(os.environ.get("BROWSE_MEDIA_CACHE_TTL", "300"))
+BROWSE_MEDIA_CACHE_SIZE = int(os.environ.get("BROWSE_MEDIA_CACHE_SIZE", "256"))
+BROWSE_MEDIA_PAGE_SIZE = int(os.environ.get("BROWSE_MEDIA_PAGE_SIZE", "100"))
+
+# Tracing (Server-Timing header, OTLP/JSON export) and profiling
+OTEL_EXPORT_FILE = os.environ.get("OTEL_EXPORT_FILE")
+OTEL_EXPORTER_OTLP_ENDPOINT = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT")
+OTEL_EXPORT_INTERVAL = 5.0
+TRACING_ENABLED = (
+    os.environ.get("TRACING_ENABLED", "false").lower() in ("1", "true", "yes")
+    or bool(OTEL_EXPORT_FILE or OTEL_EXPORTER_OTLP_ENDPOINT)
+)
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "60"))
+PROFILE_SAMPLE_INTERVAL = 0.01
+
 # Read version from config.yaml
+@lru_cache(maxsize=1)
 def get_version() -> str:
     """Reads the version from config.yaml file."""
     try:
+        # Imported here so it stays off the startup import path
+        import yaml
         # Try relative path from app folder first
         config_path = Path(__file__).parent.parent / "config.yaml"
         if not config_path.exists():
@@ -44,13 +104,967 @@ def get_version() -> str:
         logger.warning(f"Unable to read version from config.yaml: {e}")
         return "unknown"
 
-VERSION = get_version()
-
 # FastAPI app
 app = FastAPI(title="MCP Server for Home Assistant")
 
 # HTTP client for Home Assistant API
-http_client = httpx.AsyncClient(timeout=HTTP_TIMEOUT)
+# Keep pooled connections alive long enough for warm-up to pay off (httpx default is 5s)
+http_client = httpx.AsyncClient(
+    timeout=HTTP_TIMEOUT,
+    limits=httpx.Limits(
+        max_keepalive_connections=max(ADMISSION_UPSTREAM_CONCURRENCY, WARMUP_CONNECTIONS),
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    ),
+)
+
+
+# Priority classes: lower value is admitted first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+TOOL_PRIORITIES = {
+    "ha_call_service": PRIORITY_INTERACTIVE,
+    "ha_get_state": PRIORITY_INTERACTIVE,
+    "ha_fire_event": PRIORITY_INTERACTIVE,
+    "ha_render_template": PRIORITY_NORMAL,
+    "ha_get_config": PRIORITY_NORMAL,
+    "ha_list_services": PRIORITY_NORMAL,
+    "ha_list_states": PRIORITY_BULK,
+    "ha_list_states_filtered": PRIORITY_BULK,
+    "ha_get_history": PRIORITY_BULK,
+    "ha_get_logbook": PRIORITY_BULK,
+    "ha_get_changes": PRIORITY_NORMAL,
+    "ha_wait_for_state": PRIORITY_NORMAL,
+}
+
+# Long-poll tools are rate limited but do not hold a per-token concurrency slot while waiting
+LONG_POLL_TOOLS = {"ha_wait_for_state"}
+
+# Priority of the tool call being handled by the current task (read by call_ha_api)
+request_priority = contextvars.ContextVar("request_priority", default=PRIORITY_NORMAL)
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted; carries a retry hint in seconds."""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class PriorityLimiter:
+    """Concurrency limiter with a bounded queue that admits waiters by priority, then FIFO."""
+
+    def __init__(self, capacity: int, max_queue: int):
+        self.capacity = max(1, capacity)
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self._waiters = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._avg_hold = 0.5  # EWMA of slot hold time in seconds, used for retry hints
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def retry_hint(self) -> float:
+        """Rough estimate of how long until a new request could be served."""
+        return max(1.0, self._avg_hold * (self.queued / self.capacity + 1))
+
+    async def acquire(self, priority: int, timeout: float):
+        if self.in_flight < self.capacity and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            raise AdmissionRejected("queue_full", self.retry_hint())
+        
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._seq), future)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # The slot was handed over while we were giving up: pass it on
+                self.release()
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            if isinstance(e, asyncio.TimeoutError):
+                raise AdmissionRejected("queue_timeout", self.retry_hint())
+            raise
+
+    def release(self):
+        # Hand the slot directly to the best waiter, if any, so in_flight stays unchanged
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int, timeout: float):
+        with span("queue"):
+            await self.acquire(priority, timeout)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._avg_hold = 0.8 * self._avg_hold + 0.2 * (time.monotonic() - started)
+            self.release()
+
+
+class TokenBucket:
+    """Classic token bucket rate limiter."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Consume one token. Returns 0 on success, otherwise seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        if self.rate <= 0:
+            return 60.0
+        return (1 - self.tokens) / self.rate
+
+
+class ClientState:
+    """Admission state of one token."""
+
+    def __init__(self):
+        self.limiter = PriorityLimiter(ADMISSION_PER_TOKEN_CONCURRENCY, ADMISSION_QUEUE_SIZE)
+        self.bucket = TokenBucket(ADMISSION_PER_TOKEN_RATE, ADMISSION_PER_TOKEN_BURST)
+        self.long_polls = 0
+
+    @property
+    def idle(self) -> bool:
+        return self.limiter.in_flight == 0 and self.limiter.queued == 0 and self.long_polls == 0
+
+
+class AdmissionController:
+    """Per-token concurrency/rate limits plus a global cap on in-flight upstream requests."""
+
+    MAX_TRACKED_CLIENTS = 1024
+
+    def __init__(self):
+        self.upstream = PriorityLimiter(ADMISSION_UPSTREAM_CONCURRENCY, ADMISSION_QUEUE_SIZE)
+        self._clients = {}  # token hash -> ClientState
+
+    def _client(self, token: str):
+        key = token_key(token)
+        client = self._clients.get(key)
+        if client is None:
+            if len(self._clients) >= self.MAX_TRACKED_CLIENTS:
+                self._prune()
+            client = ClientState()
+            self._clients[key] = client
+        return client
+
+    def _prune(self):
+        # Forget idle clients; their buckets are refilled by the time they come back anyway
+        for key, client in list(self._clients.items()):
+            if client.idle:
+                del self._clients[key]
+
+    @asynccontextmanager
+    async def admit(self, token: str, priority: int, long_poll: bool = False):
+        """Admit one tool call for a token, applying rate limit and per-token concurrency.
+
+        Long-poll calls do not hold a concurrency slot but are capped per token instead.
+        """
+        client = self._client(token)
+        wait = client.bucket.take()
+        if wait > 0:
+            raise AdmissionRejected("rate_limited", wait)
+        if long_poll:
+            if client.long_polls >= WAIT_MAX_PER_TOKEN:
+                raise AdmissionRejected("too_many_waiters", 30.0)
+            client.long_polls += 1
+            token_var = request_priority.set(priority)
+            try:
+                yield
+            finally:
+                request_priority.reset(token_var)
+                client.long_polls -= 1
+            return
+        async with client.limiter.slot(priority, ADMISSION_QUEUE_TIMEOUT):
+            token_var = request_priority.set(priority)
+            try:
+                yield
+            finally:
+                request_priority.reset(token_var)
+
+    @asynccontextmanager
+    async def upstream_slot(self):
+        """Hold one of the global upstream slots for the duration of a Home Assistant call."""
+        async with self.upstream.slot(request_priority.get(), ADMISSION_QUEUE_TIMEOUT):
+            yield
+
+
+admission = AdmissionController()
+
+
+def token_key(token: str) -> str:
+    """Short, non-reversible identifier for a token (used as cache and limiter key)."""
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+def utc_now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class ResponseCache:
+    """TTL cache for Home Assistant GET responses.
+
+    Home Assistant filters some endpoints by the calling user's permissions; those are
+    cached per token, the others are shared by all validated clients. Concurrent misses
+    for the same entry are coalesced into a single upstream call.
+    """
+
+    # Endpoints whose content depends on the user's permissions
+    PER_USER_PATHS = {"/api/states"}
+    # Per-user entries older than this are dropped so inactive tokens do not pin memory
+    PER_USER_MAX_AGE = 300.0
+
+    def __init__(self):
+        self._entries = {}  # (path, token key or None) -> (fetched_at monotonic, fetched_at ISO, value)
+        self._pending = {}  # (path, token key or None) -> task of the in-flight fetch
+
+    def _key(self, path: str, token: str) -> tuple:
+        return (path, token_key(token) if path in self.PER_USER_PATHS else None)
+
+    def _newest(self, path: str):
+        entries = [entry for (p, _), entry in self._entries.items() if p == path]
+        return max(entries, key=lambda e: e[0]) if entries else None
+
+    def get(self, path: str, token: str, ttl: float):
+        entry = self._entries.get(self._key(path, token))
+        if entry and time.monotonic() - entry[0] < ttl:
+            return entry[2]
+        return None
+
+    def put(self, path: str, token: str, value):
+        now = time.monotonic()
+        for key, entry in list(self._entries.items()):
+            if key[1] is not None and now - entry[0] > self.PER_USER_MAX_AGE:
+                del self._entries[key]
+        self._entries[self._key(path, token)] = (now, utc_now(), value)
+
+    def invalidate(self, path: str):
+        for key in [k for k in self._entries if k[0] == path]:
+            del self._entries[key]
+
+    def fetched_at(self, path: str) -> Optional[str]:
+        entry = self._newest(path)
+        return entry[1] if entry else None
+
+    def status(self, ttls: dict) -> dict:
+        result = {}
+        for path, ttl in ttls.items():
+            entry = self._newest(path)
+            age = time.monotonic() - entry[0] if entry else None
+            result[path] = {
+                "warm": age is not None and age < ttl,
+                "age_seconds": round(age, 1) if age is not None else None,
+                "ttl_seconds": ttl
+            }
+        return result
+
+    async def fetch(self, path: str, token: str, ttl: float):
+        """Return a cached response for path, fetching it from Home Assistant when stale."""
+        value = self.get(path, token, ttl)
+        if value is not None:
+            return value
+        
+        # Run the fetch as its own task so a disconnecting caller does not cancel it for the others
+        key = self._key(path, token)
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(key, path, token))
+            self._pending[key] = task
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key: tuple, path: str, token: str):
+        try:
+            value = await call_ha_api("GET", path, token)
+            self.put(path, token, value)
+            return value
+        finally:
+            self._pending.pop(key, None)
+
+
+response_cache = ResponseCache()
+
+# Shared endpoints prefetched during warm-up, with their cache TTL.
+# Entity states are not prefetched here: they are cached per token for a few seconds only,
+# the change feed (started by warm-up with HA_WARMUP_TOKEN) is what keeps them warm.
+CACHED_ENDPOINTS = {
+    "/api/config": CACHE_TTL_CONFIG,
+    "/api/services": CACHE_TTL_SERVICES,
+}
+
+
+class UpstreamStatus:
+    """Tracks Home Assistant reachability and warm-up progress for the readiness endpoint."""
+
+    def __init__(self):
+        self.reachable = None
+        self.last_checked = None
+        self.last_error = None
+        self._checked_at = 0.0
+        self.warmup_started = False
+        self.warmup_completed_at = None
+
+    def record(self, reachable: bool, error: Optional[str] = None):
+        self.reachable = reachable
+        self.last_error = error
+        self.last_checked = utc_now()
+        self._checked_at = time.monotonic()
+
+    def is_stale(self) -> bool:
+        return time.monotonic() - self._checked_at > READINESS_PROBE_INTERVAL
+
+
+upstream_status = UpstreamStatus()
+
+
+async def probe_upstream():
+    """Check that Home Assistant answers HTTP at all (no token needed, any status counts)."""
+    try:
+        await http_client.get(f"{HA_BASE_URL}/", timeout=5.0)
+        upstream_status.record(True)
+    except httpx.RequestError as e:
+        upstream_status.record(False, str(e) or type(e).__name__)
+
+
+async def warm_up(token: str):
+    """Open pooled connections to Home Assistant, prefetch shared endpoints and start the change feed."""
+    upstream_status.warmup_started = True
+    logger.info(f"Warm-up started: opening {WARMUP_CONNECTIONS} connections and prefetching {list(CACHED_ENDPOINTS)}")
+    started = time.monotonic()
+    headers = {"Authorization": f"Bearer {token}"}
+    
+    # Concurrent requests force the pool to open separate connections
+    results = await asyncio.gather(
+        *(http_client.get(f"{HA_BASE_URL}/api/", headers=headers) for _ in range(WARMUP_CONNECTIONS)),
+        return_exceptions=True
+    )
+    errors = [r for r in results if isinstance(r, Exception)]
+    if errors:
+        logger.error(f"Warm-up could not reach Home Assistant: {errors[0]}")
+        upstream_status.record(False, str(errors[0]) or type(errors[0]).__name__)
+        upstream_status.warmup_started = False
+        return
+    upstream_status.record(True)
+    
+    results = await asyncio.gather(
+        *(response_cache.fetch(path, token, ttl) for path, ttl in CACHED_ENDPOINTS.items()),
+        return_exceptions=True
+    )
+    for path, result in zip(CACHED_ENDPOINTS, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Warm-up prefetch of {path} failed: {result}")
+    
+    # Load the entity state snapshot into the change feed (requires an admin HA_WARMUP_TOKEN)
+    if token == WARMUP_TOKEN:
+        try:
+            await state_feed.ensure_started(token)
+        except HTTPException as e:
+            logger.warning(f"Warm-up could not start the change feed: {e.detail}")
+    
+    upstream_status.warmup_completed_at = utc_now()
+    logger.info(f"Warm-up completed in {time.monotonic() - started:.2f}s")
+
+
+def start_background_task(coro) -> asyncio.Task:
+    """Start a task that does not inherit the current request's context (priority, trace)."""
+    return asyncio.create_task(coro, context=contextvars.Context())
+
+
+def ensure_warm_up(token: str):
+    """Start warm-up in the background once a usable token is known."""
+    if not upstream_status.warmup_started:
+        upstream_status.warmup_started = True
+        start_background_task(warm_up(token))
+
+
+def ha_websocket_url() -> str:
+    return re.sub(r"^http", "ws", HA_BASE_URL) + "/api/websocket"
+
+
+# Admin check (the REST API does not expose the user, the websocket API does)
+admin_cache = {}  # token hash -> (expires monotonic, is_admin)
+
+
+async def is_admin_token(token: str) -> bool:
+    """Return True if the token belongs to a Home Assistant administrator."""
+    key = token_key(token)
+    cached = admin_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    
+    # Imported here so it stays off the startup import path
+    from websockets.asyncio.client import connect
+    
+    async with connect(ha_websocket_url()) as ws:
+        await ws.recv()  # auth_required
+        await ws.send(json.dumps({"type": "auth", "access_token": token}))
+        message = json.loads(await ws.recv())
+        is_admin = False
+        if message.get("type") == "auth_ok":
+            await ws.send(json.dumps({"id": 1, "type": "auth/current_user"}))
+            message = json.loads(await ws.recv())
+            is_admin = bool(message.get("success") and message.get("result", {}).get("is_admin"))
+    
+    admin_cache[key] = (time.monotonic() + ADMIN_CHECK_TTL, is_admin)
+    return is_admin
+
+
+class StateFeed:
+    """Single websocket subscription to state_changed events, recorded in a bounded ring buffer.
+
+    Every change gets a monotonically increasing sequence number. Clients hold an opaque
+    cursor "<feed_id>:<seq>"; the feed id changes on restart so stale cursors are detected.
+
+    Home Assistant filters state_changed events by user, so the feed always runs with an
+    administrator token (HA_WARMUP_TOKEN, or the first admin caller) and non-admin callers
+    are restricted to the entities their own /api/states returns (see visible_entities).
+    """
+
+    def __init__(self, size: int):
+        self.feed_id = secrets.token_hex(4)
+        self.seq = 0
+        self.changes = deque(maxlen=size)  # (seq, entity_id, new_state or None)
+        self.states = {}  # entity_id -> latest state object
+        self.connected = False
+        self.last_event_at = None
+        self.snapshot_at = None
+        self.last_error = None
+        self.ready = asyncio.Event()
+        self._task = None
+        self._token = None
+        self._waiters = {}  # entity_id -> list of (condition, future)
+        self.waiter_count = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def cursor(self) -> str:
+        return f"{self.feed_id}:{self.seq}"
+
+    async def ensure_started(self, token: str):
+        """Start the subscription if needed and wait until the initial snapshot is loaded."""
+        if not self.running:
+            feed_token = await self._admin_token(token)
+            # Another caller may have started the feed while the admin check was awaited
+            if not self.running:
+                self._token = feed_token
+                self._task = start_background_task(self._run())
+        if self.ready.is_set():
+            return
+        # Stop waiting early if the feed task ends (e.g. token rejected)
+        waiter = asyncio.create_task(self.ready.wait())
+        await asyncio.wait({waiter, self._task}, timeout=CHANGE_FEED_START_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+        if not self.ready.is_set():
+            raise HTTPException(
+                status_code=503,
+                detail=f"Change feed not available: {self.last_error or 'subscription timed out'}"
+            )
+
+    async def _admin_token(self, token: str) -> str:
+        for candidate in (WARMUP_TOKEN, token):
+            if candidate and await check_admin(candidate):
+                return candidate
+        raise HTTPException(
+            status_code=403,
+            detail="Change feed requires an administrator token: set HA_WARMUP_TOKEN or call once with an admin token"
+        )
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+    def _record(self, entity_id: str, new_state: Optional[dict]):
+        self.seq += 1
+        self.changes.append((self.seq, entity_id, new_state))
+        if new_state is None:
+            self.states.pop(entity_id, None)
+        else:
+            self.states[entity_id] = new_state
+        self.last_event_at = utc_now()
+        
+        # Only waiters on this entity are evaluated
+        for condition, future in self._waiters.get(entity_id, ()):
+            if future.done() or new_state is None:
+                continue
+            # A failing condition must only fail its own waiter, never the feed loop
+            try:
+                matched = condition(new_state)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            if matched:
+                future.set_result(new_state)
+
+    async def wait_for(self, entity_id: str, condition, timeout: float) -> Optional[dict]:
+        """Wait until the entity state satisfies condition. Returns the matching state, or None on timeout."""
+        if self.waiter_count >= WAIT_MAX_WAITERS:
+            raise AdmissionRejected("too_many_waiters", 30.0)
+        
+        future = asyncio.get_running_loop().create_future()
+        entry = (condition, future)
+        self._waiters.setdefault(entity_id, []).append(entry)
+        self.waiter_count += 1
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.waiter_count -= 1
+            waiters = self._waiters[entity_id]
+            waiters.remove(entry)
+            if not waiters:
+                del self._waiters[entity_id]
+
+    def _apply_snapshot(self, states: list):
+        """Load a full snapshot, recording differences so existing cursors stay valid after a reconnect."""
+        snapshot = {s.get("entity_id"): s for s in states}
+        first_snapshot = self.snapshot_at is None
+        self.snapshot_at = utc_now()
+        if first_snapshot:
+            self.states = snapshot
+            return
+        for entity_id, state in snapshot.items():
+            if self.states.get(entity_id) != state:
+                self._record(entity_id, state)
+        for entity_id in [e for e in self.states if e not in snapshot]:
+            self._record(entity_id, None)
+
+    async def _run(self):
+        try:
+            await self._subscribe_loop()
+        finally:
+            # Callers must wait for a fresh snapshot from the next run, not serve this one
+            self.ready.clear()
+
+    async def _subscribe_loop(self):
+        # Imported here so it stays off the startup import path
+        from websockets.asyncio.client import connect
+        
+        ws_url = ha_websocket_url()
+        backoff = 1.0
+        while True:
+            try:
+                async with connect(ws_url, max_size=None) as ws:
+                    await ws.recv()  # auth_required
+                    await ws.send(json.dumps({"type": "auth", "access_token": self._token}))
+                    message = json.loads(await ws.recv())
+                    if message.get("type") != "auth_ok":
+                        # Token was revoked; let the next caller restart the feed with its own token
+                        self.last_error = "Home Assistant rejected the websocket token"
+                        logger.error(f"Change feed: {self.last_error}")
+                        return
+                    
+                    await ws.send(json.dumps({"id": 1, "type": "subscribe_events", "event_type": "state_changed"}))
+                    message = json.loads(await ws.recv())
+                    if not message.get("success"):
+                        raise RuntimeError(f"subscribe_events failed: {message.get('error')}")
+                    
+                    # Snapshot after subscribing so no change falls between the two
+                    self._apply_snapshot(await call_ha_api("GET", "/api/states", self._token))
+                    self.connected = True
+                    self.last_error = None
+                    self.ready.set()
+                    backoff = 1.0
+                    logger.info(f"Change feed subscribed to state_changed events ({len(self.states)} entities)")
+                    
+                    async for raw in ws:
+                        message = json.loads(raw)
+                        if message.get("type") == "event":
+                            data = message.get("event", {}).get("data", {})
+                            if data.get("entity_id"):
+                                self._record(data["entity_id"], data.get("new_state"))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.last_error = str(e) or type(e).__name__
+                logger.warning(f"Change feed connection lost: {self.last_error}, reconnecting in {backoff:.0f}s")
+            finally:
+                self.connected = False
+            
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60.0)
+
+    def get_changes(self, cursor: Optional[str], domain: Optional[str] = None, visible: Optional[set] = None) -> dict:
+        """Return entities changed since cursor, or a full snapshot when a resync is needed.
+
+        visible restricts the result to these entity ids (None means no restriction).
+        """
+        def matches(entity_id: str) -> bool:
+            if visible is not None and entity_id not in visible:
+                return False
+            return not domain or entity_id.startswith(f"{domain}.")
+        
+        reason = None
+        since = None
+        if cursor:
+            feed_id, separator, seq = cursor.partition(":")
+            if not separator or not feed_id or not seq.isdigit():
+                reason = "invalid_cursor"
+            elif feed_id != self.feed_id:
+                reason = "server_restarted"
+            elif int(seq) > self.seq:
+                reason = "invalid_cursor"
+            else:
+                since = int(seq)
+                oldest = self.changes[0][0] if self.changes else self.seq + 1
+                # Changes after the cursor must still be in the buffer
+                if since + 1 < oldest and since < self.seq:
+                    reason = "cursor_expired"
+        
+        if since is None or reason:
+            return {
+                "cursor": self.cursor(),
+                "live": self.connected,
+                "resync_required": reason is not None,
+                "reason": reason,
+                "full_snapshot": True,
+                "changes": [s for e, s in self.states.items() if matches(e)]
+            }
+        
+        # Keep only the latest change per entity, in sequence order
+        latest = {}
+        for seq, entity_id, new_state in self.changes:
+            if seq > since and matches(entity_id):
+                latest.pop(entity_id, None)
+                latest[entity_id] = new_state
+        return {
+            "cursor": self.cursor(),
+            "live": self.connected,
+            "resync_required": False,
+            "full_snapshot": False,
+            "changes": [
+                state if state is not None else {"entity_id": entity_id, "removed": True}
+                for entity_id, state in latest.items()
+            ]
+        }
+
+
+state_feed = StateFeed(CHANGE_FEED_SIZE)
+
+
+async def check_admin(token: str) -> bool:
+    """is_admin_token, with connection errors reported as 503."""
+    try:
+        return await is_admin_token(token)
+    except Exception as e:
+        logger.error(f"Failed to check admin rights with Home Assistant: {e}")
+        raise HTTPException(status_code=503, detail="Cannot reach Home Assistant")
+
+
+async def visible_entities(token: str) -> Optional[set]:
+    """Entity ids the token may read from the change feed, or None if it may read all (admin)."""
+    if await check_admin(token):
+        return None
+    states = await response_cache.fetch("/api/states", token, CHANGE_FEED_VISIBILITY_TTL)
+    return {s.get("entity_id") for s in states}
+
+
+def build_state_condition(arguments: dict):
+    """Build a predicate on a state object from ha_wait_for_state arguments."""
+    target_state = arguments.get("state")
+    not_state = arguments.get("not_state")
+    attribute = arguments.get("attribute")
+    has_value = "value" in arguments
+    value = arguments.get("value")
+    
+    if target_state is None and not_state is None and not attribute:
+        raise ValueError("state, not_state or attribute is required")
+    
+    def as_state_list(name: str, states):
+        if states is None:
+            return None
+        if isinstance(states, str):
+            return [states]
+        if isinstance(states, list) and all(isinstance(s, str) for s in states):
+            return states
+        raise ValueError(f"{name} must be a string or a list of strings")
+    
+    target_state = as_state_list("state", target_state)
+    not_state = as_state_list("not_state", not_state)
+    if attribute is not None and not isinstance(attribute, str):
+        raise ValueError("attribute must be a string")
+    
+    def condition(state: dict) -> bool:
+        if target_state is not None and state.get("state") not in target_state:
+            return False
+        if not_state is not None and state.get("state") in not_state:
+            return False
+        if attribute:
+            attributes = state.get("attributes", {})
+            if attribute not in attributes:
+                return False
+            # Compare as strings too, LLMs often pass numbers as strings
+            if has_value and attributes[attribute] != value and str(attributes[attribute]) != str(value):
+                return False
+        return True
+    
+    return condition
+
+
+class BrowseMediaCache:
+    """LRU cache of browse_media results keyed by (token, entity_id, media_content_type, media_content_id).
+
+    Entries are per token because Home Assistant checks the caller's permissions on the entity.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (fetched_at monotonic, response)
+
+    @staticmethod
+    def key(token: str, data: dict) -> tuple:
+        return (
+            token_key(token),
+            str(data.get("entity_id", "")),
+            str(data.get("media_content_type") or ""),
+            str(data.get("media_content_id") or "")
+        )
+
+    def get(self, key: tuple):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] >= self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: tuple, response):
+        self._entries[key] = (time.monotonic(), response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def find_media_id(self, token: str, entity_id: str, suffix: str) -> Optional[str]:
+        """Find a child media_content_id cached for this token and entity_id that ends with suffix.
+
+        Used to resolve a simple Spotify URI (spotify:playlist:ID) to the full
+        spotify://USER_ID/spotify:playlist:ID form returned by browse_media.
+        """
+        now = time.monotonic()
+        owner = token_key(token)
+        for (cached_owner, cached_entity, _, _), (fetched_at, response) in reversed(self._entries.items()):
+            if cached_owner != owner or cached_entity != entity_id or now - fetched_at >= self.ttl:
+                continue
+            for node in browse_nodes(response):
+                for child in node.get("children") or []:
+                    media_id = child.get("media_content_id") if isinstance(child, dict) else None
+                    if isinstance(media_id, str) and media_id != suffix and media_id.endswith("/" + suffix):
+                        return media_id
+        return None
+
+
+browse_media_cache = BrowseMediaCache(BROWSE_MEDIA_CACHE_TTL, BROWSE_MEDIA_CACHE_SIZE)
+
+
+def browse_nodes(response) -> list:
+    """Return the browse nodes (dicts with a children list) in a browse_media response.
+
+    Depending on the Home Assistant version the node is returned directly, keyed by
+    entity_id, or wrapped in service_response keyed by entity_id.
+    """
+    if not isinstance(response, dict):
+        return []
+    if "children" in response:
+        return [response]
+    if isinstance(response.get("service_response"), dict):
+        response = response["service_response"]
+    return [v for v in response.values() if isinstance(v, dict) and isinstance(v.get("children"), list)]
+
+
+def paginate_browse_response(response, offset: int, limit: int):
+    """Return a copy of a browse_media response with each children list sliced to one page."""
+    def paginate(node: dict) -> dict:
+        children = node.get("children") or []
+        if offset == 0 and len(children) <= limit:
+            return node
+        page = dict(node)
+        page["children"] = children[offset:offset + limit]
+        page["children_total"] = len(children)
+        page["offset"] = offset
+        page["limit"] = limit
+        page["next_offset"] = offset + limit if offset + limit < len(children) else None
+        return page
+    
+    if not isinstance(response, dict):
+        return response
+    if "children" in response:
+        return paginate(response)
+    result = dict(response)
+    container = result
+    if isinstance(result.get("service_response"), dict):
+        container = result["service_response"] = dict(result["service_response"])
+    for k, v in container.items():
+        if isinstance(v, dict) and isinstance(v.get("children"), list):
+            container[k] = paginate(v)
+    return result
+
+
+# Trace of the request being handled by the current task (None when tracing is disabled)
+request_trace = contextvars.ContextVar("request_trace", default=None)
+
+
+class RequestTrace:
+    """Timing spans recorded while handling one HTTP request."""
+
+    TRACEPARENT_RE = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+    def __init__(self, traceparent: Optional[str] = None):
+        m = self.TRACEPARENT_RE.match(traceparent or "")
+        self.trace_id = m.group(1) if m else secrets.token_hex(16)
+        self.parent_span_id = m.group(2) if m else None
+        self.span_id = secrets.token_hex(8)
+        self.start_ns = time.time_ns()
+        self.spans = []  # (name, start_ns, end_ns)
+
+    def server_timing(self, end_ns: int) -> str:
+        durations = {}
+        for name, start, end in self.spans:
+            durations[name] = durations.get(name, 0) + (end - start)
+        durations["total"] = end_ns - self.start_ns
+        return ", ".join(f"{name};dur={ns / 1e6:.1f}" for name, ns in durations.items())
+
+
+@contextmanager
+def span(name: str):
+    """Record a timing span on the current request trace (no-op when tracing is disabled)."""
+    trace = request_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.time_ns()
+    try:
+        yield
+    finally:
+        trace.spans.append((name, start, time.time_ns()))
+
+
+class OtlpExporter:
+    """Exports request traces as OTLP/JSON to a local file (one export request per line) and/or a collector."""
+
+    MAX_PENDING_SPANS = 10000
+
+    def __init__(self, file_path: Optional[str], endpoint: Optional[str]):
+        self.file_path = file_path
+        self.endpoint = endpoint.rstrip("/") + "/v1/traces" if endpoint else None
+        self._pending = deque(maxlen=self.MAX_PENDING_SPANS)
+        self._task = None
+
+    @staticmethod
+    def _attributes(values: dict) -> list:
+        result = []
+        for key, value in values.items():
+            if isinstance(value, bool):
+                result.append({"key": key, "value": {"boolValue": value}})
+            elif isinstance(value, int):
+                result.append({"key": key, "value": {"intValue": str(value)}})
+            else:
+                result.append({"key": key, "value": {"stringValue": str(value)}})
+        return result
+
+    def export(self, trace: RequestTrace, name: str, end_ns: int, attributes: dict):
+        root = {
+            "traceId": trace.trace_id,
+            "spanId": trace.span_id,
+            "name": name,
+            "kind": 2,  # SPAN_KIND_SERVER
+            "startTimeUnixNano": str(trace.start_ns),
+            "endTimeUnixNano": str(end_ns),
+            "attributes": self._attributes(attributes)
+        }
+        if trace.parent_span_id:
+            root["parentSpanId"] = trace.parent_span_id
+        self._pending.append(root)
+        for span_name, start, end in trace.spans:
+            self._pending.append({
+                "traceId": trace.trace_id,
+                "spanId": secrets.token_hex(8),
+                "parentSpanId": trace.span_id,
+                "name": span_name,
+                "kind": 1,  # SPAN_KIND_INTERNAL
+                "startTimeUnixNano": str(start),
+                "endTimeUnixNano": str(end)
+            })
+
+    def start(self):
+        self._task = start_background_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(OTEL_EXPORT_INTERVAL)
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        spans = list(self._pending)
+        self._pending.clear()
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": self._attributes({
+                    "service.name": "mcp-ha-server",
+                    "service.version": get_version()
+                })},
+                "scopeSpans": [{"scope": {"name": "mcp_ha"}, "spans": spans}]
+            }]
+        }
+        if self.file_path:
+            try:
+                await asyncio.to_thread(self._append_line, json.dumps(payload))
+            except OSError as e:
+                logger.warning(f"Failed to write traces to {self.file_path}: {e}")
+        if self.endpoint:
+            try:
+                await http_client.post(self.endpoint, json=payload)
+            except httpx.RequestError as e:
+                logger.warning(f"Failed to export traces to {self.endpoint}: {e}")
+
+    def _append_line(self, line: str):
+        with open(self.file_path, "a") as f:
+            f.write(line + "\n")
+
+
+otel_exporter = (
+    OtlpExporter(OTEL_EXPORT_FILE, OTEL_EXPORTER_OTLP_ENDPOINT)
+    if OTEL_EXPORT_FILE or OTEL_EXPORTER_OTLP_ENDPOINT else None
+)
 
 
 # Global request logger (before middleware)
@@ -71,8 +1085,8 @@ class AuthMiddleware(BaseHTTPMiddleware):
         logger.info(f"Path: {request.url.path}")
         logger.info(f"Headers: {dict(request.headers)}")
         
-        # Skip auth for health endpoint
-        if request.url.path.endswith("/health"):
+        # Skip auth for health and readiness endpoints
+        if request.url.path.endswith("/health") or request.url.path.endswith("/ready"):
             logger.info(f"Health check endpoint - skipping auth")
             return await call_next(request)
         
@@ -98,13 +1112,15 @@ class AuthMiddleware(BaseHTTPMiddleware):
         token = auth_header[7:]  # Remove "Bearer " prefix
         logger.info(f"Token extracted, length: {len(token)}, starts with: {token[:10]}...")
         
-        # Validate token with Home Assistant
+        # Validate token with Home Assistant (counts against the global upstream cap)
         try:
             logger.info(f"Validating token with Home Assistant at {HA_BASE_URL}/api/")
-            response = await http_client.get(
-                f"{HA_BASE_URL}/api/",
-                headers={"Authorization": f"Bearer {token}"}
-            )
+            async with admission.upstream_slot():
+                with span("auth"):
+                    response = await http_client.get(
+                        f"{HA_BASE_URL}/api/",
+                        headers={"Authorization": f"Bearer {token}"}
+                    )
             
             logger.info(f"HA validation response: {response.status_code}")
             
@@ -118,9 +1134,22 @@ class AuthMiddleware(BaseHTTPMiddleware):
             # Token is valid, attach to request state for later use
             request.state.ha_token = token
             logger.info("Token validated successfully")
+            upstream_status.record(True)
+            
+            # Without a configured warm-up token, warm up with the first valid client token
+            ensure_warm_up(token)
             
+        except AdmissionRejected as e:
+            retry_after = math.ceil(e.retry_after)
+            logger.warning(f"Token validation rejected by admission control: reason={e.reason}, retry_after={retry_after}s")
+            return JSONResponse(
+                status_code=429,
+                headers={"Retry-After": str(retry_after)},
+                content={"error": "Too Many Requests", "message": "Home Assistant is busy", "retry_after": retry_after}
+            )
         except httpx.RequestError as e:
             logger.error(f"Failed to validate token with Home Assistant: {e}")
+            upstream_status.record(False, str(e) or type(e).__name__)
             return JSONResponse(
                 status_code=503,
                 content={"error": "Service Unavailable", "message": "Cannot reach Home Assistant"}
@@ -129,8 +1158,27 @@ class AuthMiddleware(BaseHTTPMiddleware):
         return await call_next(request)
 
 
+# Tracing middleware (outermost, so auth validation is included in the trace)
+class TracingMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        trace = RequestTrace(request.headers.get("traceparent"))
+        request_trace.set(trace)
+        response = await call_next(request)
+        end_ns = time.time_ns()
+        response.headers["Server-Timing"] = trace.server_timing(end_ns)
+        if otel_exporter is not None:
+            otel_exporter.export(trace, f"{request.method} {request.url.path}", end_ns, {
+                "http.request.method": request.method,
+                "url.path": request.url.path,
+                "http.response.status_code": response.status_code
+            })
+        return response
+
+
 # Add middleware
 app.add_middleware(AuthMiddleware)
+if TRACING_ENABLED:
+    app.add_middleware(TracingMiddleware)
 
 
 # Health endpoint
@@ -140,6 +1188,155 @@ async def health():
     return {"status": "healthy", "service": "mcp-ha-server"}
 
 
+# Readiness endpoint (reports upstream reachability and cache warmth)
+@app.get("/ready")
+@app.get("/mcp/ready")
+async def ready():
+    if upstream_status.is_stale():
+        await probe_upstream()
+    
+    is_ready = bool(upstream_status.reachable)
+    return JSONResponse(
+        status_code=200 if is_ready else 503,
+        content={
+            "status": "ready" if is_ready else "not_ready",
+            "service": "mcp-ha-server",
+            "version": get_version(),
+            "upstream": {
+                "url": HA_BASE_URL,
+                "reachable": upstream_status.reachable,
+                "last_checked": upstream_status.last_checked,
+                "error": upstream_status.last_error
+            },
+            "warmup": {
+                "started": upstream_status.warmup_started,
+                "completed_at": upstream_status.warmup_completed_at
+            },
+            "cache": response_cache.status(CACHED_ENDPOINTS),
+            "last_sync": max(
+                filter(None, (state_feed.last_event_at, state_feed.snapshot_at, response_cache.fetched_at("/api/states"))),
+                default=None
+            ),
+            "change_feed": {
+                "running": state_feed.running,
+                "connected": state_feed.connected,
+                "last_event_at": state_feed.last_event_at,
+                "waiters": state_feed.waiter_count,
+                "error": state_feed.last_error
+            }
+        }
+    )
+
+
+profile_lock = asyncio.Lock()
+
+
+def sample_stacks(stop: threading.Event, interval: float) -> Counter:
+    """Sample the stacks of all other threads until stop is set, as collapsed stacks."""
+    own_id = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    samples = Counter()
+    while not stop.wait(interval):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            samples[";".join(reversed(stack))] += 1
+    return samples
+
+
+async def run_profile(seconds: float, mode: str) -> str:
+    """Profile the server for the given duration and return a text report."""
+    if mode == "cprofile":
+        # Imported here so they stay off the startup import path
+        import cProfile
+        import io
+        import pstats
+        
+        # The event loop runs in this thread, so this profiles every request handled meanwhile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(80)
+        return stream.getvalue()
+    
+    stop = threading.Event()
+    result = {}
+    sampler = threading.Thread(
+        target=lambda: result.update(samples=sample_stacks(stop, PROFILE_SAMPLE_INTERVAL)),
+        name="mcp-profiler",
+        daemon=True
+    )
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        stop.set()
+        await asyncio.to_thread(sampler.join)
+    samples = result.get("samples", Counter())
+    header = f"# {sum(samples.values())} samples every {PROFILE_SAMPLE_INTERVAL * 1000:.0f}ms over {seconds:g}s (collapsed stacks, flamegraph.pl compatible)\n"
+    return header + "\n".join(f"{stack} {count}" for stack, count in samples.most_common())
+
+
+# Profiling endpoint (admin only, disabled unless PROFILING_ENABLED)
+@app.get("/debug/profile")
+@app.get("/mcp/debug/profile")
+async def profile(request: Request, seconds: float = 10.0, mode: str = "sample"):
+    """Profile the server for N seconds and return the report as a download."""
+    if not PROFILING_ENABLED:
+        return JSONResponse(
+            status_code=404,
+            content={"error": "Not Found", "message": "Profiling is disabled, enable the profiling_enabled option"}
+        )
+    if mode not in ("sample", "cprofile"):
+        return JSONResponse(
+            status_code=400,
+            content={"error": "Bad Request", "message": "mode must be 'sample' or 'cprofile'"}
+        )
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        return JSONResponse(
+            status_code=400,
+            content={"error": "Bad Request", "message": f"seconds must be between 0 and {PROFILE_MAX_SECONDS:g}"}
+        )
+    
+    try:
+        is_admin = await is_admin_token(request.state.ha_token)
+    except Exception as e:
+        logger.error(f"Failed to check admin rights with Home Assistant: {e}")
+        return JSONResponse(
+            status_code=503,
+            content={"error": "Service Unavailable", "message": "Cannot reach Home Assistant"}
+        )
+    if not is_admin:
+        logger.warning("Profiling requested by a non-admin user")
+        return JSONResponse(
+            status_code=403,
+            content={"error": "Forbidden", "message": "Profiling requires a Home Assistant administrator token"}
+        )
+    
+    if profile_lock.locked():
+        return JSONResponse(
+            status_code=409,
+            content={"error": "Conflict", "message": "A profiling session is already running"}
+        )
+    async with profile_lock:
+        logger.info(f"Profiling session started: mode={mode}, seconds={seconds:g}")
+        report = await run_profile(seconds, mode)
+        logger.info("Profiling session completed")
+    
+    filename = f"profile-{mode}-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.txt"
+    return PlainTextResponse(report, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
 # SSE endpoint for MCP Streamable HTTP
 @app.get("/mcp")
 @app.get("/mcp/")
@@ -190,23 +1387,26 @@ async def call_ha_api(
     headers = {"Authorization": f"Bearer {token}"}
     
     try:
-        if method == "GET":
-            response = await http_client.get(url, headers=headers)
-        elif method == "POST":
-            response = await http_client.post(url, headers=headers, json=data)
-        else:
-            raise ValueError(f"Unsupported HTTP method: {method}")
+        async with admission.upstream_slot():
+            with span("upstream"):
+                if method == "GET":
+                    response = await http_client.get(url, headers=headers)
+                elif method == "POST":
+                    response = await http_client.post(url, headers=headers, json=data)
+                else:
+                    raise ValueError(f"Unsupported HTTP method: {method}")
         
         response.raise_for_status()
-        # Prefer JSON; fallback to text for endpoints like /api/template
-        content_type = response.headers.get("Content-Type", "")
-        if "application/json" in content_type:
-            return response.json()
-        # Try JSON anyway; if it fails, return raw text
-        try:
-            return response.json()
-        except Exception:
-            return response.text
+        with span("json_parse"):
+            # Prefer JSON; fallback to text for endpoints like /api/template
+            content_type = response.headers.get("Content-Type", "")
+            if "application/json" in content_type:
+                return response.json()
+            # Try JSON anyway; if it fails, return raw text
+            try:
+                return response.json()
+            except Exception:
+                return response.text
     
     except httpx.HTTPStatusError as e:
         logger.error(f"HA API error: {e.response.status_code} - {e.response.text}")
@@ -216,6 +1416,7 @@ async def call_ha_api(
         )
     except httpx.RequestError as e:
         logger.error(f"Request error calling HA API: {e}")
+        upstream_status.record(False, str(e) or type(e).__name__)
         raise HTTPException(
             status_code=503,
             detail="Cannot reach Home Assistant"
@@ -304,6 +1505,59 @@ async def handle_messages(request: Request):
                             "required": ["entity_id"]
                         }
                     },
+                    {
+                        "name": "ha_get_changes",
+                        "description": "Get only the entities whose state changed since a cursor (use instead of re-polling ha_list_states). Call without cursor to get all states and a first cursor; pass the returned cursor on the next call. If resync_required is true, the changes list is a full snapshot.",
+                        "inputSchema": {
+                            "type": "object",
+                            "properties": {
+                                "cursor": {
+                                    "type": "string",
+                                    "description": "Cursor returned by the previous ha_get_changes call (omit on first call)"
+                                },
+                                "domain": {
+                                    "type": "string",
+                                    "description": "Only return entities of this domain (e.g., 'light', 'binary_sensor')"
+                                }
+                            },
+                            "required": []
+                        }
+                    },
+                    {
+                        "name": "ha_wait_for_state",
+                        "description": "Wait until an entity reaches a state or attribute condition, or the timeout expires (use instead of polling ha_get_state in a loop). Returns immediately if the condition already holds.",
+                        "inputSchema": {
+                            "type": "object",
+                            "properties": {
+                                "entity_id": {
+                                    "type": "string",
+                                    "description": "Entity ID (e.g., cover.garage_door)"
+                                },
+                                "state": {
+                                    "type": ["string", "array"],
+                                    "items": {"type": "string"},
+                                    "description": "Target state, or list of accepted states (e.g., 'closed')"
+                                },
+                                "not_state": {
+                                    "type": ["string", "array"],
+                                    "items": {"type": "string"},
+                                    "description": "Wait until the state is no longer this value (e.g., 'running')"
+                                },
+                                "attribute": {
+                                    "type": "string",
+                                    "description": "Attribute that must be present (and equal to value, if given)"
+                                },
+                                "value": {
+                                    "description": "Expected attribute value (requires attribute)"
+                                },
+                                "timeout": {
+                                    "type": "number",
+                                    "description": f"Seconds to wait (default {WAIT_DEFAULT_TIMEOUT:.0f}, max {WAIT_MAX_TIMEOUT:.0f})"
+                                }
+                            },
+                            "required": ["entity_id"]
+                        }
+                    },
                     {
                         "name": "ha_get_history",
                         "description": "Get state history for one or more entities",
@@ -366,6 +1620,14 @@ async def handle_messages(request: Request):
                                 "data": {
                                     "type": "object",
                                     "description": "Service call data"
+                                },
+                                "offset": {
+                                    "type": "integer",
+                                    "description": "media_player.browse_media only: index of the first child to return (default 0)"
+                                },
+                                "limit": {
+                                    "type": "integer",
+                                    "description": f"media_player.browse_media only: max children to return (default {BROWSE_MEDIA_PAGE_SIZE})"
                                 }
                             },
                             "required": ["domain", "service"]
@@ -432,7 +1694,28 @@ async def handle_messages(request: Request):
             
             # Wrap tool execution to catch HA API errors and return 200 with structured error
             try:
-                tool_result = await execute_tool(tool_name, arguments, token)
+                async with admission.admit(
+                    token,
+                    TOOL_PRIORITIES.get(tool_name, PRIORITY_NORMAL),
+                    long_poll=tool_name in LONG_POLL_TOOLS
+                ):
+                    tool_result = await execute_tool(tool_name, arguments, token)
+            except AdmissionRejected as e:
+                retry_after = math.ceil(e.retry_after)
+                logger.warning(f"Tool call rejected by admission control: tool={tool_name}, reason={e.reason}, retry_after={retry_after}s")
+                return JSONResponse(
+                    status_code=429,
+                    headers={"Retry-After": str(retry_after)},
+                    content={
+                        "jsonrpc": "2.0",
+                        "error": {
+                            "code": -32000,
+                            "message": "Too many requests",
+                            "data": {"reason": e.reason, "retry_after": retry_after, "tool": tool_name}
+                        },
+                        "id": request_id
+                    }
+                )
             except HTTPException as e:
                 # Return 200 with structured error info for agent consumption
                 status_code = e.status_code
@@ -450,7 +1733,7 @@ async def handle_messages(request: Request):
                 "content": [
                     {
                         "type": "text",
-                        "text": json.dumps(tool_result, indent=2)
+                        "text": serialize_tool_result(tool_result)
                     }
                 ]
             }
@@ -479,13 +1762,18 @@ async def handle_messages(request: Request):
         logger.error(f"Error handling MCP request: method={method}, error={e}", exc_info=True)
 
 
+def serialize_tool_result(tool_result) -> str:
+    with span("serialize"):
+        return json.dumps(tool_result, indent=2)
+
+
 def get_error_suggestion(status_code: int, detail: str, tool_name: str, arguments: dict) -> str:
     """
     Generate context-aware error suggestions based on status code, error message,
     tool name, and arguments.
     """
     if status_code == 404:
-        if tool_name == "ha_get_state":
+        if tool_name in ("ha_get_state", "ha_wait_for_state"):
             entity_id = arguments.get("entity_id", "")
             return (
                 f"Entity '{entity_id}' not found. Check the entity_id spelling or use "
@@ -553,19 +1841,20 @@ def get_error_suggestion(status_code: int, detail: str, tool_name: str, argument
 async def execute_tool(tool_name: str, arguments: dict, token: str):
     """Execute a tool and return the result."""
     if tool_name == "ha_list_states":
-        tool_result = await call_ha_api("GET", "/api/states", token)
+        tool_result = await response_cache.fetch("/api/states", token, CACHE_TTL_STATES)
     
     elif tool_name == "ha_list_states_filtered":
         # Get all states and filter locally
-        all_states = await call_ha_api("GET", "/api/states", token)
+        all_states = await response_cache.fetch("/api/states", token, CACHE_TTL_STATES)
         domain_filter = arguments.get("domain")
         state_filter = arguments.get("state")
         
         filtered_states = all_states
-        if domain_filter:
-            filtered_states = [s for s in filtered_states if s.get("entity_id", "").startswith(f"{domain_filter}.")]
-        if state_filter:
-            filtered_states = [s for s in filtered_states if s.get("state") == state_filter]
+        with span("filter"):
+            if domain_filter:
+                filtered_states = [s for s in filtered_states if s.get("entity_id", "").startswith(f"{domain_filter}.")]
+            if state_filter:
+                filtered_states = [s for s in filtered_states if s.get("state") == state_filter]
         
         tool_result = filtered_states
     
@@ -575,6 +1864,46 @@ async def execute_tool(tool_name: str, arguments: dict, token: str):
             raise ValueError("entity_id is required")
         tool_result = await call_ha_api("GET", f"/api/states/{entity_id}", token)
     
+    elif tool_name == "ha_get_changes":
+        await state_feed.ensure_started(token)
+        visible = await visible_entities(token)
+        with span("filter"):
+            tool_result = state_feed.get_changes(arguments.get("cursor"), arguments.get("domain"), visible)
+    
+    elif tool_name == "ha_wait_for_state":
+        entity_id = arguments.get("entity_id")
+        if not entity_id:
+            raise ValueError("entity_id is required")
+        condition = build_state_condition(arguments)
+        timeout = arguments.get("timeout")
+        # timeout 0 means "check now"; only a missing timeout gets the default
+        if timeout is None:
+            timeout = WAIT_DEFAULT_TIMEOUT
+        else:
+            try:
+                timeout = float(timeout)
+            except (TypeError, ValueError):
+                raise HTTPException(status_code=400, detail="timeout must be a number")
+            if math.isnan(timeout):
+                raise HTTPException(status_code=400, detail="timeout must be a number")
+            timeout = min(max(timeout, 0.0), WAIT_MAX_TIMEOUT)
+        
+        await state_feed.ensure_started(token)
+        visible = await visible_entities(token)
+        current = state_feed.states.get(entity_id)
+        if current is None or (visible is not None and entity_id not in visible):
+            raise HTTPException(status_code=404, detail=f"Entity not found: {entity_id}")
+        
+        started = time.monotonic()
+        matched_state = current if condition(current) else await state_feed.wait_for(entity_id, condition, timeout)
+        tool_result = {
+            "entity_id": entity_id,
+            "matched": matched_state is not None,
+            "timed_out": matched_state is None,
+            "waited_seconds": round(time.monotonic() - started, 1),
+            "state": matched_state or state_feed.states.get(entity_id)
+        }
+    
     elif tool_name == "ha_get_history":
         entity_id = arguments.get("entity_id")
         start_time = arguments.get("start_time")
@@ -644,7 +1973,7 @@ async def execute_tool(tool_name: str, arguments: dict, token: str):
             }
     
     elif tool_name == "ha_list_services":
-        tool_result = await call_ha_api("GET", "/api/services", token)
+        tool_result = await response_cache.fetch("/api/services", token, CACHE_TTL_SERVICES)
     
     elif tool_name == "ha_call_service":
         domain = arguments.get("domain")
@@ -697,13 +2026,19 @@ async def execute_tool(tool_name: str, arguments: dict, token: str):
                         # Check if format is correct (spotify://USER_ID/spotify:playlist:ID)
                         if media_id.startswith("spotify:") and not media_id.startswith("spotify://"):
                             logger.warning(f"Incorrect Spotify URI format for Sonos")
-                            return {
+                            error = {
                                 "error": "incorrect_spotify_format",
                                 "message": "Simple Spotify URI format (spotify:playlist:ID) not supported on Sonos.",
                                 "required_format": "spotify://USER_ID/spotify:playlist:ID",
                                 "solution": "Use browse_media to get the full URI with USER_ID prefix. Cannot be manually constructed.",
                                 "example": "spotify://01k4n3c1ng6fvkcrfc752qj8qe/spotify:playlist:3qzL8UVzyomQCSy86oOxZo"
                             }
+                            # A previous browse_media call may already have returned the full URI
+                            full_media_id = browse_media_cache.find_media_id(token, entity_id, media_id)
+                            if full_media_id:
+                                error["suggested_media_content_id"] = full_media_id
+                                error["solution"] = "Retry play_media with suggested_media_content_id (found in browse_media results)."
+                            return error
                         
                         # Check for enqueue parameter
                         if "enqueue" not in data:
@@ -727,19 +2062,34 @@ async def execute_tool(tool_name: str, arguments: dict, token: str):
                 data["entity_id"] = entity_id
                 logger.info(f"Cleaned entity_id to: {entity_id}")
             
-            # browse_media requires ?return_response=true in query parameters
-            logger.info(f"browse_media requires return_response=true query parameter")
+            try:
+                offset = max(int(arguments.get("offset") or 0), 0)
+                limit = max(int(arguments.get("limit") or BROWSE_MEDIA_PAGE_SIZE), 1)
+            except (TypeError, ValueError):
+                raise HTTPException(status_code=400, detail="offset and limit must be integers")
             
-            # Call with query parameter
-            tool_result = await call_ha_api("POST", f"/api/services/{domain}/{service}?return_response=true", token, data)
+            # Browsing is slow (seconds per level on Spotify/Sonos), serve repeated browses from cache
+            cache_key = BrowseMediaCache.key(token, data)
+            tool_result = browse_media_cache.get(cache_key)
+            if tool_result is not None:
+                logger.info(f"browse_media cache hit for {cache_key}")
+            else:
+                # browse_media requires ?return_response=true in query parameters
+                logger.info(f"browse_media requires return_response=true query parameter")
+                
+                # Call with query parameter
+                tool_result = await call_ha_api("POST", f"/api/services/{domain}/{service}?return_response=true", token, data)
+                browse_media_cache.put(cache_key, tool_result)
             
             # Return early to avoid the default call at the end
-            return tool_result
+            return paginate_browse_response(tool_result, offset, limit)
 
         tool_result = await call_ha_api("POST", f"/api/services/{domain}/{service}", token, data)
+        # Service calls usually change entity states
+        response_cache.invalidate("/api/states")
     
     elif tool_name == "ha_get_config":
-        tool_result = await call_ha_api("GET", "/api/config", token)
+        tool_result = await response_cache.fetch("/api/config", token, CACHE_TTL_CONFIG)
     
     elif tool_name == "ha_get_logbook":
         entity_id = arguments.get("entity_id")
@@ -769,6 +2119,7 @@ async def execute_tool(tool_name: str, arguments: dict, token: str):
             raise ValueError("event_type is required")
         
         tool_result = await call_ha_api("POST", f"/api/events/{event_type}", token, event_data or {})
+        response_cache.invalidate("/api/states")
     
     else:
         raise ValueError(f"Unknown tool: {tool_name}")
@@ -776,14 +2127,30 @@ async def execute_tool(tool_name: str, arguments: dict, token: str):
     return tool_result
 
 
+async def log_version():
+    logger.info(f"MCP Server version: v{get_version()}")
+
+
 # Startup event
 @app.on_event("startup")
 async def startup():
-    logger.info(f"MCP Server v{VERSION} starting with HA_BASE_URL: {HA_BASE_URL}")
+    logger.info(f"MCP Server starting with HA_BASE_URL: {HA_BASE_URL}")
+    # Reading the version parses config.yaml; do it once the server is accepting requests
+    start_background_task(log_version())
+    if otel_exporter is not None:
+        otel_exporter.start()
+    # Warm up in the background so the server starts accepting requests immediately
+    if WARMUP_TOKEN:
+        ensure_warm_up(WARMUP_TOKEN)
+    else:
+        logger.info("HA_WARMUP_TOKEN not set, warm-up will run after the first authenticated request")
 
 
 # Shutdown event
 @app.on_event("shutdown")
 async def shutdown():
+    await state_feed.stop()
+    if otel_exporter is not None:
+        await otel_exporter.stop()
     await http_client.aclose()
     logger.info("MCP Server shutdown complete")
@@ -2,6 +2,26 @@
 set -e
 
 echo "Starting MCP Server for Home Assistant..."
+
+# Export add-on options as environment variables (e.g. tracing_enabled -> TRACING_ENABLED)
+OPTIONS_FILE=/data/options.json
+if [ -f "$OPTIONS_FILE" ]; then
+    eval "$(python3 - "$OPTIONS_FILE" <<'PY'
+import json
+import shlex
+import sys
+
+with open(sys.argv[1]) as f:
+    options = json.load(f)
+for key, value in options.items():
+    if value is None or value == "":
+        continue
+    if isinstance(value, bool):
+        value = "true" if value else "false"
+    print(f"export {key.upper()}={shlex.quote(str(value))}")
+PY
+)"
+fi
 echo "HA Base URL: ${HA_BASE_URL:-http://homeassistant:8123}"
 
 exec uvicorn app.main:app \